@@ -9,6 +9,16 @@ from google_auth_oauthlib.flow import InstalledAppFlow
 # Start read-only; later use gmail.modify when you want to change labels
 SCOPES = ["https://www.googleapis.com/auth/gmail.readonly"]
 
+# Credentials already loaded in this process, keyed by use_env
+_CREDS: dict[bool, Credentials] = {}
+
+
+def _write_token(token_path: Path, creds: Credentials):
+    """Write token.json atomically so a crash never leaves a partial file."""
+    tmp_path = token_path.with_name(token_path.name + ".tmp")
+    tmp_path.write_text(creds.to_json())
+    os.replace(tmp_path, token_path)
+
 
 def get_creds_from_file():
     """File-based authentication using token.json and credentials.json"""
@@ -22,7 +32,7 @@ def get_creds_from_file():
         else:
             flow = InstalledAppFlow.from_client_secrets_file("credentials.json", SCOPES)
             creds = flow.run_local_server(port=8181)
-        token_path.write_text(creds.to_json())
+        _write_token(token_path, creds)
     return creds
 
 
@@ -58,11 +68,28 @@ def get_creds(use_env=False):
     Args:
         use_env: If True, use GMAIL_TOKEN_JSON from environment.
                  If False, use token.json file (default).
+
+    Credentials are loaded once per process and only refreshed when expired.
     """
+    creds = _CREDS.get(use_env)
+    if creds is not None:
+        if creds.valid:
+            return creds
+        if creds.expired and creds.refresh_token:
+            creds.refresh(Request())
+            if use_env:
+                print("Token was refreshed. Updated token JSON:")
+                print(creds.to_json())
+            else:
+                _write_token(Path("token.json"), creds)
+            return creds
+
     if use_env:
-        return get_creds_from_env()
+        creds = get_creds_from_env()
     else:
-        return get_creds_from_file()
+        creds = get_creds_from_file()
+    _CREDS[use_env] = creds
+    return creds
 
 
 if __name__ == "__main__":
@@ -1,15 +1,35 @@
 # read_inbox_and_classify.py
 from __future__ import annotations
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Optional, Tuple
+from dataclasses import dataclass, field
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+from googleapiclient.http import build_http
+from googleapiclient.model import JsonModel
+from google_auth_httplib2 import AuthorizedHttp
 from auth_gmail import get_creds
+import asyncio
 import base64
-import os, textwrap
-from tenacity import retry, wait_exponential, stop_after_attempt
+import hashlib
+import random
+import sqlite3
+import threading
+import time
+import os, re, textwrap
+from tenacity import (
+    retry,
+    retry_if_exception_type,
+    stop_after_attempt,
+    wait_exponential,
+)
+from email.utils import parseaddr, parsedate_to_datetime
 from pathlib import Path
+from urllib.parse import urlsplit
 from dotenv import load_dotenv
 import json
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
 import argparse
 
 SALES_PHRASES = [
@@ -35,18 +55,50 @@ SALES_PHRASES = [
 ]
 
 
-def looks_salesy(subject: str, snippet: str) -> bool:
-    t = f"{subject} {snippet}".lower()
-    return any(p in t for p in SALES_PHRASES)
+SURVEY_PHRASES = [
+    "rate your experience",
+    "how did we do",
+    "tell us about your visit",
+    "your recent purchase",
+    "share your feedback",
+    "survey",
+]
+
+
+def _phrase_re(phrases: List[str]) -> re.Pattern:
+    """One alternation over all phrases so the text is scanned once.
+
+    Phrases are lowercase and matched against pre-lowercased text.
+    """
+    return re.compile("|".join(re.escape(p.lower()) for p in phrases))
+
+
+_SALES_RE = _phrase_re(SALES_PHRASES)
+_SURVEY_RE = _phrase_re(SURVEY_PHRASES)
+# Pulls the outermost {...} out of a model reply that isn't pure JSON
+_JSON_OBJ_RE = re.compile(r"\{.*\}", re.DOTALL)
+# Reason given when the model reply can't be parsed; such verdicts are
+# provisional and never cached or recorded
+NON_JSON_REASON = "non-json response"
+
 
+def looks_salesy_lower(subj_l: str, snip_l: str) -> bool:
+    return bool(_SALES_RE.search(f"{subj_l} {snip_l}"))
 
-def gemini_generate_json(payload: dict) -> dict:
-    """Call Gemini v1beta REST and return parsed JSON {label, reason}."""
+
+def gemini_generate_json(payload: dict, system: Optional[str] = None) -> dict:
+    """Call Gemini v1beta REST and return parsed JSON {label, reason}.
+
+    Pass system=BATCH_SYSTEM_RULES with {"emails": [...]} to get {"results": [...]}.
+    """
     api_key = os.environ["GOOGLE_API_KEY"]
-    url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:generateContent?key={api_key}"
+    url = f"{GEMINI_API_BASE}/models/{GEMINI_MODEL}:generateContent?key={api_key}"
 
     body = {
-        "system_instruction": {"role": "user", "parts": [{"text": SYSTEM_RULES}]},
+        "system_instruction": {
+            "role": "user",
+            "parts": [{"text": system or SYSTEM_RULES}],
+        },
         "generation_config": {
             "temperature": 0,
             "response_mime_type": "application/json",
@@ -54,14 +106,12 @@ def gemini_generate_json(payload: dict) -> dict:
         "contents": [
             {
                 "role": "user",
-                "parts": [{"text": json.dumps(payload, ensure_ascii=False)}],
+                "parts": [{"text": orjson.dumps(payload).decode("utf-8")}],
             }
         ],
     }
 
-    r = requests.post(
-        url, json=body, headers={"Content-Type": "application/json"}, timeout=30
-    )
+    r = http_request("POST", url, data=orjson.dumps(body), timeout=30)
     if r.status_code != 200:
         try:
             print("Gemini REST error:", r.status_code, r.json())
@@ -69,7 +119,7 @@ def gemini_generate_json(payload: dict) -> dict:
             print("Gemini REST error:", r.status_code, r.text[:500])
         r.raise_for_status()
 
-    data = r.json()
+    data = orjson.loads(r.content)
     text = (
         data.get("candidates", [{}])[0]
         .get("content", {})
@@ -78,18 +128,16 @@ def gemini_generate_json(payload: dict) -> dict:
         .strip()
     )
     try:
-        return json.loads(text)
+        return orjson.loads(text)
     except Exception:
-        import re
-
-        m = re.search(r"\{.*\}", text, flags=re.S)
+        m = _JSON_OBJ_RE.search(text)
         if m:
             try:
-                return json.loads(m.group(0))
+                return orjson.loads(m.group(0))
             except Exception:
                 pass
         print("Warning: model returned non-JSON:", text[:200])
-        return {"label": "NOT_SPAM", "reason": "non-json response"}
+        return {"label": "NOT_SPAM", "reason": NON_JSON_REASON}
 
 
 def openai_generate_json(payload: dict) -> dict:
@@ -168,25 +216,99 @@ def openai_generate_json(payload: dict) -> dict:
         text = response.choices[0].message.content.strip()
         return json.loads(text)
     except json.JSONDecodeError:
-        import re
-
-        m = re.search(r"\{.*\}", text, flags=re.S)
+        m = _JSON_OBJ_RE.search(text)
         if m:
             try:
                 return json.loads(m.group(0))
             except Exception:
                 pass
         print("Warning: model returned non-JSON:", text[:200])
-        return {"label": "NOT_SPAM", "reason": "non-json response"}
+        return {"label": "NOT_SPAM", "reason": NON_JSON_REASON}
 
 
 # ---- Globals ----------------------------------------------------------------
 _SERVICE = None  # will be set in main()
+_CREDS = None  # will be set in main(); used for per-thread Gmail transports
 _API_PROVIDER = "gemini"  # will be set by command-line arg: "gemini" or "openai"
 MAX_BODY_CHARS = 2000  # safe default for trimming long message bodies
+# Fetch the full body only when the snippet is shorter than this. Gmail caps
+# snippets at roughly 200 chars, so longer ones already carry the opening text.
+NEEDS_BODY_THRESHOLD = 150
+BODY_FIELDS = "payload(mimeType,body/data,parts(mimeType,body/data,parts))"
+GMAIL_CONCURRENCY = 10  # parallel messages.get calls (Gmail per-user quota)
+LLM_CONCURRENCY = 5  # parallel LLM calls (provider RPM limits)
+LLM_BATCH_SIZE = 16  # emails per batched Gemini request
+LLM_BATCH_TOKENS = 12000  # rough input budget per batched request
+GEMINI_MODEL = "gemini-2.0-flash"
+GEMINI_API_BASE = "https://generativelanguage.googleapis.com/v1beta"
+LLM_CACHE_PATH = Path(__file__).resolve().parent / ".llm_cache.sqlite"
+STATE_PATH = Path(__file__).resolve().parent / "state.json"  # last synced historyId
+MAX_PENDING_ATTEMPTS = 3  # runs an unprocessed message is retried before giving up
+CLASSIFICATIONS_PATH = Path(__file__).resolve().parent / "classifications.db"
+DENY_DOMAINS_PATH = Path(__file__).resolve().parent / "deny_domains.txt"
+MAX_QUERY_DENY_DOMAINS = 50  # keep the Gmail search query a sane length
+_THREAD_LOCAL = threading.local()
+_DENY_DOMAINS: frozenset[str] = frozenset()  # loaded from DENY_DOMAINS_PATH in main()
+
+# One keep-alive session for all Gemini REST calls so TLS connections are reused;
+# the pool is sized so every concurrent LLM worker keeps its own connection.
+_HTTP = requests.Session()
+_HTTP.headers["Content-Type"] = "application/json"
+_HTTP.mount("https://", HTTPAdapter(pool_maxsize=LLM_CONCURRENCY))
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+HTTP_MAX_ATTEMPTS = 5
+GMAIL_NUM_RETRIES = 5  # googleapiclient's built-in exponential backoff
+_BACKOFF_LOCK = threading.Lock()
+_BACKOFF_UNTIL: Dict[str, float] = {}  # host -> time before which no request is sent
+
+
+def _retry_delay(r: requests.Response, attempt: int) -> float:
+    """Seconds to wait before retrying: Retry-After if given, else exponential."""
+    value = r.headers.get("Retry-After")
+    if value:
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            try:
+                return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+    return float(min(2**attempt, 32))
+
+
+def http_request(method: str, url: str, **kwargs) -> requests.Response:
+    """Send a request on _HTTP, retrying 429/5xx responses.
+
+    A retryable response pauses every caller for that host until the backoff
+    has elapsed, so concurrent workers don't stampede a rate-limited API.
+    The final response is returned as-is; callers check the status.
+    """
+    host = urlsplit(url).netloc
+    for attempt in range(HTTP_MAX_ATTEMPTS):
+        with _BACKOFF_LOCK:
+            wait = _BACKOFF_UNTIL.get(host, 0.0) - time.time()
+        if wait > 0:
+            time.sleep(wait)
+        r = _HTTP.request(method, url, **kwargs)
+        if r.status_code not in RETRY_STATUSES or attempt == HTTP_MAX_ATTEMPTS - 1:
+            return r
+        delay = _retry_delay(r, attempt) + random.uniform(0, 0.3)
+        r.close()
+        with _BACKOFF_LOCK:
+            _BACKOFF_UNTIL[host] = max(
+                _BACKOFF_UNTIL.get(host, 0.0), time.time() + delay
+            )
+    return r
+
 
 # ---- Gemini setup ------------------------------------------------------------
 load_dotenv(Path(__file__).resolve().parent / ".env", override=True)
+# Env-driven settings are read here, after .env has been loaded
+# Seconds a cached LLM verdict stays valid; 0 disables the cache, minimum 60
+LLM_CACHE_TTL = int(os.environ.get("LLM_CACHE_TTL", "86400"))
+if LLM_CACHE_TTL:
+    LLM_CACHE_TTL = max(LLM_CACHE_TTL, 60)
 SYSTEM_RULES = """
 You are an email gate. Classify ONE email as SPAM or NOT_SPAM.
 
@@ -209,6 +331,18 @@ Return exactly one JSON object on one line:
 No extra text.
 """.strip()
 
+BATCH_SYSTEM_RULES = (
+    SYSTEM_RULES
+    + """
+
+Batch mode (overrides Output above):
+The input is {"emails":[...]} and every email has an "id". Classify each email independently with the rules above.
+Return exactly one JSON object on one line:
+{"results":[{"id":"<id>","label":"SPAM|NOT_SPAM","reason":"10–25 words"}]}
+Include every id exactly once. No extra text.
+"""
+).strip()
+
 # Require the API key to be present and fail early with a clear message.
 API_KEY = os.environ.get("GOOGLE_API_KEY")
 if not API_KEY:
@@ -221,42 +355,334 @@ def redact(text: str) -> str:
     return text.replace("\r", " ").replace("\n", " ").strip()
 
 
+# ---- LLM response cache ------------------------------------------------------
+# Exact-match cache of {label, reason} keyed by a hash of everything that
+# influences the answer (provider, model, rules, payload). An in-process dict
+# sits in front of a SQLite file so verdicts survive across runs.
+_CACHE_LOCK = threading.Lock()
+_CACHE_MEM: Dict[str, Tuple[float, dict]] = {}
+_CACHE_DB = None
+
+
+def _cache_db() -> sqlite3.Connection:
+    global _CACHE_DB
+    if _CACHE_DB is None:
+        _CACHE_DB = sqlite3.connect(LLM_CACHE_PATH, check_same_thread=False)
+        _CACHE_DB.execute(
+            "CREATE TABLE IF NOT EXISTS responses"
+            "(key TEXT PRIMARY KEY, value TEXT NOT NULL, ts REAL NOT NULL)"
+        )
+    return _CACHE_DB
+
+
+def cache_key(payload: dict) -> str:
+    if _API_PROVIDER == "openai":
+        model = os.environ.get("OPENAI_MODEL", "gpt-4o-mini")
+    else:
+        model = GEMINI_MODEL
+    material = {
+        "provider": _API_PROVIDER,
+        "model": model,
+        "rules": SYSTEM_RULES,
+        "payload": payload,
+    }
+    blob = json.dumps(material, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+
+def cache_get(key: str) -> Optional[dict]:
+    if not LLM_CACHE_TTL:
+        return None
+    cutoff = time.time() - LLM_CACHE_TTL
+    with _CACHE_LOCK:
+        hit = _CACHE_MEM.get(key)
+        if hit is None:
+            row = (
+                _cache_db()
+                .execute("SELECT ts, value FROM responses WHERE key = ?", (key,))
+                .fetchone()
+            )
+            if row is not None:
+                hit = _CACHE_MEM[key] = (row[0], json.loads(row[1]))
+    if hit is None or hit[0] < cutoff:
+        return None
+    return hit[1]
+
+
+def cache_put(key: str, obj: dict) -> None:
+    if not LLM_CACHE_TTL:
+        return
+    now = time.time()
+    with _CACHE_LOCK:
+        _CACHE_MEM[key] = (now, obj)
+        db = _cache_db()
+        db.execute(
+            "INSERT OR REPLACE INTO responses (key, value, ts) VALUES (?, ?, ?)",
+            (key, json.dumps(obj, ensure_ascii=False), now),
+        )
+        db.execute("DELETE FROM responses WHERE ts < ?", (now - LLM_CACHE_TTL,))
+        db.commit()
+
+
 # ---- Gmail helpers -----------------------------------------------------------
+class OrjsonModel(JsonModel):
+    """googleapiclient response model that parses JSON with orjson."""
+
+    def deserialize(self, content):
+        try:
+            return orjson.loads(content)
+        except orjson.JSONDecodeError:
+            return super().deserialize(content)
+
+
+def _thread_http():
+    """Return an authorized HTTP transport owned by the calling thread.
+
+    httplib2 is not thread-safe, so worker threads must not share the
+    transport built into _SERVICE.
+    """
+    if _CREDS is None:
+        return None
+    http = getattr(_THREAD_LOCAL, "http", None)
+    if http is None:
+        http = _THREAD_LOCAL.http = AuthorizedHttp(_CREDS, http=build_http())
+    return http
+
+
 def list_message_ids(service, q: str = "in:inbox", max_results: int = 20) -> List[str]:
     resp = (
         service.users()
         .messages()
-        .list(userId="me", q=q, maxResults=max_results)
-        .execute()
+        .list(userId="me", q=q, maxResults=max_results, fields="messages/id")
+        .execute(num_retries=GMAIL_NUM_RETRIES)
     )
     return [m["id"] for m in resp.get("messages", [])]
 
 
+def current_history_id(service) -> str:
+    return (
+        service.users()
+        .getProfile(userId="me", fields="historyId")
+        .execute(num_retries=GMAIL_NUM_RETRIES)["historyId"]
+    )
+
+
+def list_new_message_ids(service, start_history_id: str) -> Tuple[List[str], str]:
+    """Return (ids of messages added to INBOX since start_history_id, latest historyId).
+
+    Raises HttpError with status 404 when start_history_id is too old.
+    """
+    ids: List[str] = []
+    seen = set()
+    history_id = start_history_id
+    history = service.users().history()
+    request = history.list(
+        userId="me",
+        startHistoryId=start_history_id,
+        historyTypes=["messageAdded"],
+        labelId="INBOX",
+        fields="history/messagesAdded/message/id,historyId,nextPageToken",
+    )
+    while request is not None:
+        resp = request.execute(num_retries=GMAIL_NUM_RETRIES)
+        for record in resp.get("history", []):
+            for added in record.get("messagesAdded", []):
+                msg_id = added["message"]["id"]
+                if msg_id not in seen:
+                    seen.add(msg_id)
+                    ids.append(msg_id)
+        history_id = resp.get("historyId", history_id)
+        request = history.list_next(request, resp)
+    return ids, history_id
+
+
+def load_state() -> Dict[str, Any]:
+    try:
+        return json.loads(STATE_PATH.read_text())
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def carry_pending(prev: Dict[str, int], unprocessed: List[str]) -> Dict[str, int]:
+    """Count another attempt for each unprocessed id; give up after the limit."""
+    pending: Dict[str, int] = {}
+    for msg_id in unprocessed:
+        attempts = prev.get(msg_id, 0) + 1
+        if attempts < MAX_PENDING_ATTEMPTS:
+            pending[msg_id] = attempts
+        else:
+            print(f"Warning: giving up on {msg_id} after {attempts} attempts")
+    return pending
+
+
+def save_state(state: Dict[str, Any]) -> None:
+    tmp_path = STATE_PATH.with_name(STATE_PATH.name + ".tmp")
+    tmp_path.write_text(json.dumps(state))
+    os.replace(tmp_path, STATE_PATH)
+
+
+# ---- Classification store ----------------------------------------------------
+# Gmail message ids are stable, so anything already classified is skipped.
+def open_store(path: Path = CLASSIFICATIONS_PATH) -> sqlite3.Connection:
+    con = sqlite3.connect(path)
+    con.execute("PRAGMA journal_mode=WAL")
+    con.execute(
+        "CREATE TABLE IF NOT EXISTS c"
+        "(id TEXT PRIMARY KEY, label TEXT NOT NULL, reason TEXT, ts INTEGER NOT NULL)"
+    )
+    return con
+
+
+def known_ids(con: sqlite3.Connection, ids: List[str]) -> set[str]:
+    found: set[str] = set()
+    for start in range(0, len(ids), 500):  # stay under SQLite's variable limit
+        chunk = ids[start : start + 500]
+        marks = ",".join("?" * len(chunk))
+        rows = con.execute(f"SELECT id FROM c WHERE id IN ({marks})", chunk)
+        found.update(row[0] for row in rows)
+    return found
+
+
+def record_verdicts(
+    con: sqlite3.Connection, verdicts: List[Tuple[str, bool, str]]
+) -> None:
+    now = int(time.time())
+    with con:
+        con.executemany(
+            "INSERT OR REPLACE INTO c (id, label, reason, ts) VALUES (?, ?, ?, ?)",
+            [
+                (msg_id, "SPAM" if is_spam else "NOT_SPAM", reason, now)
+                for msg_id, is_spam, reason in verdicts
+            ],
+        )
+
+
 def sender_matches(email_from: str, needles: list[str]) -> bool:
     f = (email_from or "").lower()
     return any(n in f for n in needles)
 
 
-def get_message_meta(service, msg_id: str) -> Dict[str, Any]:
-    msg = (
+def load_deny_domains(path: Path = DENY_DOMAINS_PATH) -> frozenset[str]:
+    """Read one sender domain per line; blank lines and # comments are ignored."""
+    try:
+        lines = path.read_text().splitlines()
+    except FileNotFoundError:
+        return frozenset()
+    domains = (line.split("#", 1)[0].strip().lower() for line in lines)
+    return frozenset(d for d in domains if d)
+
+
+def sender_denied(email_from: str, domains: frozenset[str]) -> bool:
+    """True if the sender's domain, or any parent domain, is in `domains`."""
+    if not domains:
+        return False
+    domain = parseaddr(email_from or "")[1].rpartition("@")[2].lower()
+    while domain:
+        if domain in domains:
+            return True
+        domain = domain.partition(".")[2]
+    return False
+
+
+def exclude_senders_query(q: str, domains: frozenset[str]) -> str:
+    """Append -from:(a OR b ...) so Gmail drops denied senders server-side."""
+    if not domains or len(domains) > MAX_QUERY_DENY_DOMAINS:
+        return q
+    return f"{q} -from:({' OR '.join(sorted(domains))})"
+
+
+GMAIL_BATCH_LIMIT = 100  # Gmail rejects batches with more than 100 calls
+META_HEADERS = ("From", "Subject", "Date")
+META_FIELDS = "id,payload/headers,snippet"  # partial response: drop unused fields
+
+
+def _meta_request(service, msg_id: str):
+    return (
         service.users()
         .messages()
         .get(
             userId="me",
             id=msg_id,
             format="metadata",
-            metadataHeaders=["From", "Subject", "Date"],
+            metadataHeaders=list(META_HEADERS),
+            fields=META_FIELDS,
         )
-        .execute()
     )
-    headers = {h["name"]: h["value"] for h in msg["payload"].get("headers", [])}
-    return {
-        "id": msg_id,
-        "from": headers.get("From", ""),
-        "subject": headers.get("Subject", ""),
-        "date": headers.get("Date", ""),
-        "snippet": msg.get("snippet", ""),
-    }
+
+
+@dataclass
+class EmailMeta:
+    """Message metadata; lowercase copies are computed once for the rule checks."""
+
+    id: str
+    frm: str
+    subj: str
+    snip: str
+    date: str
+    subj_l: str = field(init=False)
+    snip_l: str = field(init=False)
+
+    def __post_init__(self):
+        self.subj_l = self.subj.lower()
+        self.snip_l = self.snip.lower()
+
+
+def _meta_from_message(msg_id: str, msg: Dict[str, Any]) -> EmailMeta:
+    # Single pass; metadataHeaders already limits Gmail to the META_HEADERS
+    frm = subj = date = ""
+    for h in msg["payload"].get("headers", ()):
+        name = h["name"]
+        if name == "From":
+            frm = h["value"]
+        elif name == "Subject":
+            subj = h["value"]
+        elif name == "Date":
+            date = h["value"]
+    return EmailMeta(
+        id=msg_id, frm=frm, subj=subj, snip=msg.get("snippet", ""), date=date
+    )
+
+
+def fetch_meta_batch(service, ids: List[str]) -> Tuple[Dict[str, EmailMeta], List[str]]:
+    """Fetch metadata for many messages using batched HTTP requests.
+
+    Calls rejected with 429/5xx are re-batched with exponential backoff.
+    Returns ({msg_id: meta}, failed_ids); failed_ids only holds transient
+    failures (rate limits, 5xx, transport errors) worth retrying on a later run.
+    """
+    results: Dict[str, EmailMeta] = {}
+    failed: List[str] = []
+    retry_ids: List[str] = []
+
+    def store(request_id, response, exception):
+        if exception is None:
+            results[request_id] = _meta_from_message(request_id, response)
+        elif (
+            isinstance(exception, HttpError) and exception.resp.status in RETRY_STATUSES
+        ):
+            retry_ids.append(request_id)
+        else:
+            print(f"Warning: metadata fetch failed for {request_id}: {exception}")
+            # Other HTTP errors (400 bad id, 403, 404 deleted) won't fix themselves
+            if not isinstance(exception, HttpError):
+                failed.append(request_id)
+
+    pending = list(ids)
+    for attempt in range(GMAIL_NUM_RETRIES + 1):
+        if attempt:
+            time.sleep(min(2**attempt, 32) + random.uniform(0, 0.3))
+        retry_ids.clear()
+        for start in range(0, len(pending), GMAIL_BATCH_LIMIT):
+            batch = service.new_batch_http_request(callback=store)
+            for msg_id in pending[start : start + GMAIL_BATCH_LIMIT]:
+                batch.add(_meta_request(service, msg_id), request_id=msg_id)
+            batch.execute()
+        if not retry_ids:
+            break
+        pending = list(retry_ids)
+    for msg_id in retry_ids:
+        print(f"Warning: metadata fetch for {msg_id} still rate limited; skipped")
+    return results, failed + retry_ids
 
 
 def get_plaintext_body(service=None, msg_id: str = "") -> str:
@@ -265,86 +691,233 @@ def get_plaintext_body(service=None, msg_id: str = "") -> str:
     if not service or not msg_id:
         return ""
     msg = (
-        service.users().messages().get(userId="me", id=msg_id, format="full").execute()
+        service.users()
+        .messages()
+        .get(userId="me", id=msg_id, format="full", fields=BODY_FIELDS)
+        .execute(http=_thread_http(), num_retries=GMAIL_NUM_RETRIES)
     )
 
-    def walk(parts):
-        for p in parts:
-            if p.get("mimeType") == "text/plain" and "data" in p.get("body", {}):
-                return base64.urlsafe_b64decode(p["body"]["data"]).decode(
-                    "utf-8", errors="ignore"
-                )
-            if "parts" in p:
-                content = walk(p["parts"])
-                if content:
-                    return content
-        return ""
-
-    payload = msg.get("payload", {})
-    if payload.get("mimeType") == "text/plain" and "data" in payload.get("body", {}):
-        return base64.urlsafe_b64decode(payload["body"]["data"]).decode(
-            "utf-8", errors="ignore"
-        )
-    return walk(payload.get("parts", [])) or ""
+    # Iterative depth-first walk in document order; stops at the first text/plain
+    # part so a text/plain attachment never wins over the real body.
+    stack = [msg.get("payload") or {}]
+    while stack:
+        part = stack.pop()
+        body = part.get("body") or {}
+        if part.get("mimeType") == "text/plain" and "data" in body:
+            return base64.urlsafe_b64decode(body["data"].encode("ascii")).decode(
+                "utf-8", errors="ignore"
+            )
+        stack.extend(reversed(part.get("parts") or ()))
+    return ""
 
 
 # ---- LLM classifier ----------------------------------------------------------
-from typing import Tuple
-
-
-@retry(wait=wait_exponential(min=1, max=8), stop=stop_after_attempt(3))
-def classifier(email: Dict[str, Any]) -> Tuple[bool, str]:
-    """
-    Returns (is_spam, reason).
-    Order:
-      1) Hard, local rules (deterministic & fast)
-      2) Gemini fallback with strict JSON
-    """
-    frm = email.get("from", "")
-    subj = (email.get("subject") or "").lower()
-    snip = (email.get("snippet") or "").lower()
-
-    # --- 1) Hard rules (local)
-    if sender_matches(frm, ["thegivingblock.com", "the giving block"]):
+def rule_classify(email: EmailMeta) -> Optional[Tuple[bool, str]]:
+    """Hard, local rules (deterministic & fast). Returns None when no rule fires."""
+    if sender_matches(email.frm, ["thegivingblock.com", "the giving block"]):
         return True, "Domain matches thegivingblock.com hard rule"
 
-    survey_phrases = [
-        "rate your experience",
-        "how did we do",
-        "tell us about your visit",
-        "your recent purchase",
-        "share your feedback",
-        "survey",
-    ]
-    if any(p in subj for p in survey_phrases) or any(p in snip for p in survey_phrases):
+    if sender_denied(email.frm, _DENY_DOMAINS):
+        return True, "Sender domain is on the deny list"
+
+    if _SURVEY_RE.search(email.subj_l) or _SURVEY_RE.search(email.snip_l):
         return True, "Post-purchase survey / rating request"
 
-    if looks_salesy(email.get("subject", ""), email.get("snippet", "")):
+    if looks_salesy_lower(email.subj_l, email.snip_l):
         return True, "Sales outreach / booking language detected"
 
-    # --- 2) LLM fallback (send minimal content; SYSTEM_RULES covers salesy too)
-    body = redact(get_plaintext_body(msg_id=email.get("id", "")))[:MAX_BODY_CHARS]
-    user_email = {
-        "from": frm,
-        "subject": email.get("subject", ""),
-        "snippet": email.get("snippet", ""),
-        "body": body,
+    return None
+
+
+# Only transport failures are retried here: http_request() already handles
+# 429/5xx, and other HTTP errors (400/403, ...) won't succeed on a retry.
+_retry_transport_errors = retry(
+    retry=retry_if_exception_type((requests.ConnectionError, requests.Timeout)),
+    wait=wait_exponential(min=1, max=8),
+    stop=stop_after_attempt(3),
+)
+
+
+def llm_payload(email: EmailMeta, body: str) -> Dict[str, str]:
+    """Minimal content sent to the LLM (SYSTEM_RULES covers salesy too)."""
+    return {
+        "from": email.frm,
+        "subject": email.subj,
+        "snippet": email.snip,
+        "body": redact(body)[:MAX_BODY_CHARS],
     }
 
-    # Use configured API provider
-    if _API_PROVIDER == "openai":
-        obj = openai_generate_json(user_email)
-    else:  # default to gemini
-        obj = gemini_generate_json(user_email)
 
+def _clean_answer(obj: Any) -> Optional[Dict[str, str]]:
+    """Return {label, reason} if the model gave a valid label, else None."""
+    if not isinstance(obj, dict):
+        return None
+    label = str(obj.get("label") or "").upper()
+    if label not in ("SPAM", "NOT_SPAM"):
+        return None
+    return {"label": label, "reason": str(obj.get("reason") or "Model classification")}
+
+
+def _verdict(obj: dict) -> Tuple[bool, str]:
     label = (obj.get("label") or "").upper()
     reason = obj.get("reason") or "Model classification"
     return (label == "SPAM", reason)
 
 
+def _estimate_tokens(payload: dict) -> int:
+    # ~4 characters per token is close enough for budgeting requests
+    return len(orjson.dumps(payload)) // 4 + 1
+
+
+def plan_batches(payloads: Dict[str, dict]) -> List[Dict[str, dict]]:
+    """Split {msg_id: payload} into batches bounded by count and token budget.
+
+    A payload too large for any batch is left out so it gets a single call.
+    """
+    batches: List[Dict[str, dict]] = []
+    current: Dict[str, dict] = {}
+    used = 0
+    for msg_id, payload in payloads.items():
+        tokens = _estimate_tokens(payload)
+        if tokens > LLM_BATCH_TOKENS:
+            continue
+        if current and (
+            len(current) >= LLM_BATCH_SIZE or used + tokens > LLM_BATCH_TOKENS
+        ):
+            batches.append(current)
+            current, used = {}, 0
+        current[msg_id] = payload
+        used += tokens
+    if current:
+        batches.append(current)
+    return batches
+
+
+@_retry_transport_errors
+def llm_classify_payload(payload: Dict[str, str]) -> Tuple[bool, str]:
+    key = cache_key(payload)
+    obj = cache_get(key)
+    if obj is None:
+        # Use configured API provider
+        if _API_PROVIDER == "openai":
+            obj = openai_generate_json(payload)
+        else:  # default to gemini
+            obj = gemini_generate_json(payload)
+        answer = _clean_answer(obj)
+        if answer is None:
+            # Invalid/missing label: keep it provisional, like a non-JSON reply
+            obj = {"label": "NOT_SPAM", "reason": NON_JSON_REASON}
+        elif obj.get("reason") != NON_JSON_REASON:
+            obj = answer
+            cache_put(key, obj)
+    return _verdict(obj)
+
+
+@_retry_transport_errors
+def llm_classify_batch(payloads: Dict[str, dict]) -> Dict[str, Tuple[bool, str]]:
+    """Classify several emails in one Gemini request.
+
+    Returns verdicts for the ids the model answered with a valid label;
+    callers fall back to llm_classify_payload() for anything missing.
+    """
+    emails = [{"id": msg_id, **payload} for msg_id, payload in payloads.items()]
+    obj = gemini_generate_json({"emails": emails}, system=BATCH_SYSTEM_RULES)
+    verdicts: Dict[str, Tuple[bool, str]] = {}
+    for item in obj.get("results") or []:
+        msg_id = item.get("id") if isinstance(item, dict) else None
+        answer = _clean_answer(item)
+        if answer is not None and msg_id in payloads and msg_id not in verdicts:
+            cache_put(cache_key(payloads[msg_id]), answer)
+            verdicts[msg_id] = _verdict(answer)
+    return verdicts
+
+
+def needs_body(email: EmailMeta) -> bool:
+    """True when the snippet is too short to classify on its own."""
+    return len(email.snip) < NEEDS_BODY_THRESHOLD
+
+
+async def classify_all(
+    emails: List[EmailMeta],
+) -> List[Optional[Tuple[bool, str]]]:
+    """Classify emails concurrently; returns (is_spam, reason) in input order.
+
+    Rules run first, then short-snippet bodies are fetched in parallel and
+    cache misses are sent to Gemini in batches (one request per message for
+    OpenAI). A failed Gemini batch falls back to per-message calls; a message
+    whose body fetch or own call fails gets None instead of a verdict.
+    """
+    gmail_sem = asyncio.Semaphore(GMAIL_CONCURRENCY)
+    llm_sem = asyncio.Semaphore(LLM_CONCURRENCY)
+
+    async def run(sem: asyncio.Semaphore, fn, *args, **kwargs):
+        async with sem:
+            return await asyncio.to_thread(fn, *args, **kwargs)
+
+    async def attempt(what: str, sem: asyncio.Semaphore, fn, *args, **kwargs):
+        # One failing message or batch must not abort the whole run
+        try:
+            return await run(sem, fn, *args, **kwargs)
+        except Exception as e:
+            print(f"Warning: {what} failed: {e}")
+            return None
+
+    verdicts: Dict[str, Optional[Tuple[bool, str]]] = {}
+    pending = []
+    for email in emails:
+        verdict = rule_classify(email)
+        if verdict is None:
+            pending.append(email)
+        else:
+            verdicts[email.id] = verdict
+
+    async def fetch_body(email: EmailMeta) -> Optional[str]:
+        if not needs_body(email):
+            return ""
+        return await attempt(
+            f"body fetch for {email.id}",
+            gmail_sem,
+            get_plaintext_body,
+            msg_id=email.id,
+        )
+
+    bodies = await asyncio.gather(*(fetch_body(e) for e in pending))
+    payloads: Dict[str, dict] = {}
+    for email, body in zip(pending, bodies):
+        if body is None:
+            verdicts[email.id] = None
+            continue
+        payload = llm_payload(email, body)
+        hit = cache_get(cache_key(payload))
+        if hit is None:
+            payloads[email.id] = payload
+        else:
+            verdicts[email.id] = _verdict(hit)
+
+    if _API_PROVIDER != "openai":
+        results = await asyncio.gather(
+            *(
+                attempt("LLM batch", llm_sem, llm_classify_batch, b)
+                for b in plan_batches(payloads)
+            )
+        )
+        for result in results:
+            verdicts.update(result or {})
+
+    leftovers = [msg_id for msg_id in payloads if msg_id not in verdicts]
+    singles = await asyncio.gather(
+        *(
+            attempt(f"LLM call for {i}", llm_sem, llm_classify_payload, payloads[i])
+            for i in leftovers
+        )
+    )
+    verdicts.update(zip(leftovers, singles))
+    return [verdicts[email.id] for email in emails]
+
+
 # ---- Main --------------------------------------------------------------------
 def main():
-    global _SERVICE, _API_PROVIDER
+    global _SERVICE, _CREDS, _API_PROVIDER, _DENY_DOMAINS
 
     # Parse command-line arguments
     parser = argparse.ArgumentParser(description="Gmail spam classifier using LLMs")
@@ -356,6 +929,7 @@ def main():
     )
     args = parser.parse_args()
     _API_PROVIDER = args.api
+    _DENY_DOMAINS = load_deny_domains()
 
     # Determine Gmail authentication mode from environment variable
     # Options: "file" (default) or "env"
@@ -367,18 +941,72 @@ def main():
     else:
         print("Using file-based authentication (token.json)")
 
-    _SERVICE = build("gmail", "v1", credentials=get_creds(use_env=use_env_auth))
+    _CREDS = get_creds(use_env=use_env_auth)
+    _SERVICE = build(
+        "gmail",
+        "v1",
+        credentials=_CREDS,
+        cache_discovery=False,
+        model=OrjsonModel(),
+    )
 
     print(f"Using {_API_PROVIDER.upper()} API for classification\n")
 
-    ids = list_message_ids(_SERVICE, q="in:inbox newer_than:7d", max_results=10)
-    for msg_id in ids:
-        meta = get_message_meta(_SERVICE, msg_id)
-        is_spam, reason = classifier(meta)
+    # Incremental run: only messages added since the last stored historyId.
+    # Without state (first run) or when it has expired, scan the recent inbox.
+    ids = None
+    state = load_state()
+    start_history_id = state.get("historyId")
+    if start_history_id:
+        try:
+            ids, history_id = list_new_message_ids(_SERVICE, start_history_id)
+            print(f"{len(ids)} new message(s) since last run\n")
+        except HttpError as e:
+            if e.resp.status != 404:
+                raise
+            print("Stored historyId expired; scanning recent inbox instead\n")
+    if ids is None:
+        # Read the history position first so nothing arriving mid-run is skipped
+        history_id = current_history_id(_SERVICE)
+        q = exclude_senders_query("in:inbox newer_than:7d", _DENY_DOMAINS)
+        ids = list_message_ids(_SERVICE, q=q, max_results=10)
+    # Messages left unprocessed last run (fetch failed, unparseable model reply)
+    prev_pending = state.get("pending") or {}
+    if isinstance(prev_pending, list):  # older state files kept a bare id list
+        prev_pending = dict.fromkeys(prev_pending, 0)
+    ids = list(dict.fromkeys(ids + list(prev_pending)))
+
+    store = open_store()
+    seen = known_ids(store, ids)
+    if seen:
+        print(f"Skipping {len(seen)} already-classified message(s)\n")
+        ids = [msg_id for msg_id in ids if msg_id not in seen]
+
+    metas, unprocessed = fetch_meta_batch(_SERVICE, ids)
+    emails = [metas[msg_id] for msg_id in ids if msg_id in metas]
+    results = asyncio.run(classify_all(emails))
+    classified = [(m, v) for m, v in zip(emails, results) if v is not None]
+    unprocessed += [m.id for m, v in zip(emails, results) if v is None]
+    for meta, (is_spam, reason) in classified:
         tag = "SPAM ⛔" if is_spam else "legit ❎"
-        print(f"[{tag}] {meta['date']} | {meta['from']} | {meta['subject']}")
+        print(f"[{tag}] {meta.date} | {meta.frm} | {meta.subj}")
         print(f"   reason: {reason}")
-        print(f"   {meta['snippet'][:160]}{'…' if len(meta['snippet']) > 160 else ''}")
+        print(f"   {meta.snip[:160]}{'…' if len(meta.snip) > 160 else ''}")
+
+    record_verdicts(
+        store,
+        [
+            (meta.id, is_spam, reason)
+            for meta, (is_spam, reason) in classified
+            if reason != NON_JSON_REASON
+        ],
+    )
+    store.close()
+    unprocessed += [m.id for m, (_, r) in classified if r == NON_JSON_REASON]
+    pending = carry_pending(prev_pending, unprocessed)
+    if pending:
+        print(f"{len(pending)} message(s) not classified; will retry next run")
+    save_state({"historyId": history_id, "pending": pending})
 
 
 if __name__ == "__main__":